@@ -2,8 +2,22 @@
 	Breakpoint is the PDB-based way to stop the tracer.
 """
 
-from weakref import WeakValueDictionary
-from collections import defaultdict
+from __future__ import with_statement
+
+from weakref import WeakValueDictionary, WeakKeyDictionary
+from types import CodeType
+from itertools import count
+from threading import RLock
+
+try:
+	_ = property.setter
+except AttributeError:
+	from shared.tools.compat import property
+
+try:
+	from shared.tools.compat import next
+except ImportError:
+	pass
 
 from shared.tools.debug.frame import normalize_filename
 
@@ -14,36 +28,107 @@ __maintainer__ = 'Andrew Geiger'
 __email__ = 'andrew.geiger@corsosystems.com'
 
 
+# Returned when nothing is relevant, so the common case allocates nothing
+EMPTY_FROZENSET = frozenset()
+
+# Bound here so the tracer's condition checks skip the builtins lookup
+_eval = eval
+
+# Resolved once, so Python 3 (without long or unicode) can load this too
+try:
+	_INT_TYPES = (int, long)
+	_STR_TYPES = (str, unicode)
+except NameError:
+	_INT_TYPES = (int,)
+	_STR_TYPES = (str,)
+
+try:
+	_intern = intern
+except NameError:
+	from sys import intern as _intern
+
+
+class _PartyState(object):
+	"""What an interested party (like a Tracer) has set on a breakpoint."""
+	__slots__ = ('enabled', 'ignored')
+
+	def __init__(self):
+		self.enabled = False # no one is interested by default
+		self.ignored = 0
+
+
 class Breakpoint(object):
 	"""Note that breakpoints are explicit, while a trap is much more commonly
 	  evaluated. Traps are rooting about for a situation while the debugger
 	  effectively brings the situation to the breakpoint to be verified.
 	"""
 	__slots__ = ('_id', '_filename', '_line_number', '_function_name',
-				 'temporary', 'condition', 'hits', 
-				 'enabled', 'ignored',
+				 '_temporary', '_condition', '_condition_code', 'hits', 
+				 '_party_state',
+				 'trip',
 				 'note',
+				 '_str_cache',
 				 '__weakref__',
 				 )
 
-	_id_counter = 0
+	# IDs are never reused, so a counter that only goes up is all that's needed.
+	#   (The next one is taken in _add, under _lock along with the rest of the tracking.)
+	_ids = count(1)
+
+	# Held across every change to what's tracked or enabled (and the tracer rebuilt from it),
+	#   since Jython has no GIL and tracers in other threads add, trip, and remove breakpoints.
+	#   (Reentrant, since removing a breakpoint disables it for everyone first.)
+	_lock = RLock()
 
 	_instances = {}
-	_break_locations = {(None, None): set()}
+	# Breakpoints by filename, then by line number or function name
+	#   (a filename of None means the breakpoint may fire in any file)
+	# The breakpoints at a location are a tuple, since the tracer only ever
+	#   iterates them, and replacing it whole means iterating is always safe.
+	_break_locations = {}
+	# Gate for the tracer: co_filename spellings that have any breakpoints,
+	#   mapped to the (interned) filename their breakpoints are under
+	#   (None is in here if there are breakpoints that may fire in any file)
+	_files_with_breaks = {}
+
+	# The same layout as _break_locations, but only what each party has enabled
+	#   (so the tracer doesn't have to skip past what the party isn't interested in)
+	_enabled_by_party = WeakKeyDictionary()
+
+	# The tracer's first check, generated to match the breakpoints set (see _rebuild_tracer)
+	_fast_trace = staticmethod(lambda frame: False)
+
+	# First line numbers of functions, by the code of the frame being checked
+	#   (weakly, so an entry can't outlive - or be mistaken for - its code)
+	_first_line_cache = WeakKeyDictionary()
 
 
 	def __init__(self, filename=None, location=None, 
 				 temporary=False, condition=None, note=''):
 
-		self._filename = normalize_filename(filename or '') or None
+		self._id = 0 # not tracked yet (see _add)
+
+		# Interned, since the tracer looks breakpoints up by filename every line
+		normalized = normalize_filename(filename or '') or None
+		if type(normalized) is str:
+			normalized = _intern(normalized)
+		self._filename = normalized
 		try:
 			line_number = int(location)
 			self._line_number = line_number
 			self._function_name = ''
-		except ValueError:
+		except (TypeError, ValueError):
 			self._line_number = None
 			self._function_name = location
 
+		# Pick the trip check once, rather than branching on every trip
+		if self._function_name:
+			self.trip = self._trip_function
+		elif not any((self._line_number, self._filename)):
+			self.trip = self._trip_always
+		else:
+			self.trip = self._trip_line
+
 		# A purely contextless breakpoint should not be abided for long.
 		# (since it'll stop. on. every. single. line.)
 		if not temporary and not any((filename, location, condition)):
@@ -58,9 +143,9 @@ class Breakpoint(object):
 
 		self.hits = 0
 
-		# use Tracer/PDB instance as key for number of hits
-		self.enabled = defaultdict(bool) # no one is interested by default
-		self.ignored = defaultdict(int)
+		# use Tracer/PDB instance as key for its enabled state and ignore count
+		#   (weakly, so a dead tracer's settings go with it)
+		self._party_state = WeakKeyDictionary()
 
 		self._add()
 
@@ -89,72 +174,171 @@ class Breakpoint(object):
 		return self._id
 
 
-	@classmethod
-	def next_id(cls):
-		cls._id_counter += 1
-		return cls._id_counter
+	# Properties that change how the breakpoint is displayed
+
+	@property
+	def temporary(self):
+		return self._temporary
+
+	@temporary.setter
+	def temporary(self, temporary):
+		self._temporary = temporary
+		self._str_cache = None
+
+	@property
+	def condition(self):
+		return self._condition
+
+	@condition.setter
+	def condition(self, condition):
+		"""Compile the condition once here, rather than on every trip."""
+		self._str_cache = None
+		if not condition:
+			self._condition = None
+			self._condition_code = None
+		elif isinstance(condition, CodeType):
+			self._condition = condition
+			self._condition_code = condition
+		else:
+			self._condition_code = compile(condition, '<breakpoint condition>', 'eval')
+			self._condition = condition
+
 
 	@property
 	def location(self):
-		return (self.filename, self.function_name or self.line_number)
+		return (self.filename, self._location_key)
+
+	@property
+	def _location_key(self):
+		return self.function_name or self.line_number
 
 
 	@classmethod
 	def resolve_breakpoints(cls, breakpoint_ids):
+		# A single breakpoint or ID is the common case
+		id_type = type(breakpoint_ids)
+		if id_type is Breakpoint:
+			return [breakpoint_ids]
+		if id_type is int:
+			return [cls._instances[breakpoint_ids]]
+
 		# coerce to iterable, if needed
 		if not isinstance(breakpoint_ids, (list, tuple, set)):
 			breakpoint_ids = [breakpoint_ids] 
 
 		breakpoints = []
 		for breakpoint in breakpoint_ids:
-			if isinstance(breakpoint, Breakpoint):
-				breakpoints.append(breakpoint)
-			elif isinstance(breakpoint, (long, int)):
-				breakpoints.append(cls._instances[breakpoint])
-			elif isinstance(breakpoint, (str, unicode)):
-				breakpoints.extend(cls._break_locations[breakpoint])
+			resolve = _BREAKPOINT_RESOLVERS.get(type(breakpoint))
+			if resolve:
+				resolve(cls, breakpoint, breakpoints)
 		return breakpoints
 
 
 	def _add(self):
 		"""Add the breakpoint to the class' tracking. If set leave it."""
-		try:
+		with self._lock:
 			if self._id:
 				return
-		except AttributeError:
-			if self.location in self._break_locations:
-				self._break_locations[self.location].add(self)
-			else:
-				self._break_locations[self.location] = set([self])
+
+			_file_breakpoint(self._break_locations, self)
 			
-			self._id = self.next_id()
+			for code_filename in self._code_filenames(self.filename):
+				self._files_with_breaks[code_filename] = self.filename
+
+			self._id = next(self._ids)
 			self._instances[self.id] = self 
 
+			self._rebuild_tracer()
+
 	def _remove(self):
-		self.enabled.clear()
-		del self._instances[self.id]
-		self._break_locations[self.location].remove(self)
+		with self._lock:
+			# A temporary breakpoint may trip in more than one thread, but it's only removed once
+			if self._instances.get(self._id) is not self:
+				return
 
+			for interested_party in list(self._party_state.keys()):
+				self.disable(interested_party)
+			self._party_state.clear()
+			del self._instances[self.id]
 
-	def trip(self, frame):
-		"""Determine if the breakpoint should trip given the frame context."""
-	
-		# Breakpoint set by line
-		if not self.function_name:
-			# always trip on contextless breakpoints
-			if not any((self.line_number, self.filename)):
-				return True
-			else:
-				return (    self.line_number == frame.f_lineno 
-					    and (not self.filename 
-					    	  or self.filename == normalize_filename(frame.f_code.co_filename) ) )
+			# Drop the file from the gate once its last breakpoint is gone
+			if not _unfile_breakpoint(self._break_locations, self):
+				for code_filename in self._code_filenames(self.filename):
+					del self._files_with_breaks[code_filename]
+
+			self._rebuild_tracer()
+
+
+	@classmethod
+	def _rebuild_tracer(cls):
+		"""Generate a function that checks if a frame is at any breakpoint's location.
+
+		Breakpoints are set rarely but checked every traced line, and there are
+		  usually only a few. (Call this holding _lock, so the check can't be
+		  built from the breakpoints as they were before another thread's change.) So the locations are written right into the check
+		  as literals, leaving a handful of comparisons for each line.
+		For example, with breakpoints at line 10 and function foo of a.py:
+
+			def _fast_trace(frame):
+				code = frame.f_code
+				if code.co_filename in ('a.py', '<a.py>'):
+					if frame.f_lineno in (10,): return True
+					if code.co_name in ('foo',): return True
+				return False
+		"""
+		source = ['def _fast_trace(frame):']
+
+		# Breakpoints that may fire in any file can't be narrowed down
+		if None in cls._break_locations:
+			source.append('\treturn True')
+		else:
+			source.append('\tcode = frame.f_code')
+			for filename, in_file in cls._break_locations.items():
+				line_numbers = tuple(sorted(key for key in in_file if isinstance(key, _INT_TYPES)))
+				function_names = tuple(sorted(key for key in in_file if isinstance(key, _STR_TYPES)))
+				if not (line_numbers or function_names):
+					continue
+				source.append('\tif code.co_filename in %r:' % (cls._code_filenames(filename),))
+				if line_numbers:
+					source.append('\t\tif frame.f_lineno in %r: return True' % (line_numbers,))
+				if function_names:
+					source.append('\t\tif code.co_name in %r: return True' % (function_names,))
+			source.append('\treturn False')
+
+		namespace = {}
+		exec(compile('\n'.join(source), '<breakpoint tracer>', 'exec'), namespace)
+		cls._fast_trace = staticmethod(namespace['_fast_trace'])
+
+
+	@staticmethod
+	def _code_filenames(filename):
+		"""The co_filename spellings that normalize to the given filename."""
+		if filename is None:
+			return (None,)
+		return (filename, '<%s>' % filename)
 
+
+	# The trip slot is set to one of these in __init__ to 
+	#   determine if the breakpoint should trip given the frame context.
+
+	def _trip_always(self, frame):
+		"""Always trip on contextless breakpoints."""
+		return True
+
+	def _trip_line(self, frame):
+		"""Trip on the breakpoint's line (in its file, if set)."""
+		return (    self._line_number == frame.f_lineno 
+			    and (not self._filename 
+			    	  or self._filename == normalize_filename(frame.f_code.co_filename) ) )
+
+	def _trip_function(self, frame):
+		"""Trip on the first line of the breakpoint's function (in its file, if set)."""
 		# Fail if the function name's wrong
-		if self.function_name != frame.f_code.co_name:
+		if self._function_name != frame.f_code.co_name:
 			return False
 
 		# Fail if we're on the right function in the wrong file
-		if self.filename and self.filename != normalize_filename(frame.f_code.co_filename):
+		if self._filename and self._filename != normalize_filename(frame.f_code.co_filename):
 			return False
 
 		# Correct frame and correct function
@@ -166,121 +350,207 @@ class Breakpoint(object):
 
 
 	def _function_first_line(self, frame_scope):
-		"""Grab the function's first line number from the frame scope."""
+		"""Grab the function's first line number from the frame scope.
+
+		Resolving the function means materializing the caller's locals, so
+		  the result is cached against the code being run. Rebinding the 
+		  function (or reloading its module) runs new code, so it's looked up again.
+		"""
+		code = frame_scope.f_code
+		first_line = self._first_line_cache.get(code)
+		if first_line is not None:
+			return first_line
+
+		caller = frame_scope.f_back
 		try:
-			function = frame_scope.f_back.f_locals[self.function_name]
+			function = caller.f_locals[self.function_name]
 		except KeyError:
-			function = frame_scope.f_back.f_globals[self.function_name]
-		return function.func_code.co_firstlineno
+			function = caller.f_globals[self.function_name]
+		first_line = function.func_code.co_firstlineno
 
+		self._first_line_cache[code] = first_line
+		return first_line
 
-	@staticmethod
-	def frame_location_by_line(frame):
-		return (normalize_filename(frame.f_code.co_filename), frame.f_lineno)
 
-	@staticmethod
-	def frame_location_by_function(frame):
-		return (normalize_filename(frame.f_code.co_filename), frame.f_code.co_name)
+	def _state(self, interested_party):
+		"""Get the interested_party's settings for this breakpoint, creating them if needed."""
+		# None is the default party elsewhere, but it's no one to keep settings for
+		if interested_party is None:
+			raise TypeError('Breakpoint settings need an interested party (like a Tracer), not None')
+		state = self._party_state.get(interested_party)
+		if state is None:
+			state = self._party_state[interested_party] = _PartyState()
+		return state
 
 
 	def enable(self, interested_party):
-		"""Enable the breakpoint for the interested_party"""
-		self.enabled[interested_party] = True
+		"""Enable the breakpoint for the interested_party
+
+		The party is held weakly, so it must be weakly referenceable (a Tracer is).
+		"""
+		with self._lock:
+			state = self._state(interested_party)
+			if state.enabled:
+				return
+			state.enabled = True
+
+			# Only breakpoints still being tracked can be found by the tracer
+			if self._instances.get(self._id) is self:
+				enabled = self._enabled_by_party.get(interested_party)
+				if enabled is None:
+					enabled = self._enabled_by_party[interested_party] = {}
+				_file_breakpoint(enabled, self)
 		
 	def disable(self, interested_party):
 		"""Disable the breakpoint for the interested_party (this is the default state)"""
-		self.enabled[interested_party] = False
+		# Nothing is ever enabled for no one
+		if interested_party is None:
+			return
+		with self._lock:
+			state = self._party_state.get(interested_party)
+			if state is None or not state.enabled:
+				return
+			state.enabled = False
+
+			enabled = self._enabled_by_party.get(interested_party)
+			if enabled:
+				_unfile_breakpoint(enabled, self)
 
 	def ignore(self, interested_party, num_passes=0):
 		"""Ignore this breakpoint for num_passes times for the interested_party"""
-		self.ignored[interested_party] = num_passes
+		self._state(interested_party).ignored = num_passes
 
 
 	@classmethod
-	def relevant_breakpoints(cls, frame, interested_party=None):
-		relevant = set()
+	def iter_relevant_breakpoints(cls, frame, interested_party=None):
+		"""Yield the breakpoints the interested_party should stop on for this frame.
+
+		Checking a breakpoint counts its hit, spends an ignore pass, and removes
+		  it if temporary, so candidates after the last one taken are left untouched.
+
+		The interested_party is whatever breakpoints were enabled for, so it
+		  must be weakly referenceable. The default of None has nothing enabled.
+		"""
+		code = frame.f_code
+
+		# Most frames are in files without breakpoints, so bail before any real work
+		#   (and nothing can be enabled for no one). The wrappers below have
+		#   already run _fast_trace; this gate is for calling the generator directly.
+		files_with_breaks = cls._files_with_breaks
+		if not (code.co_filename in files_with_breaks or None in files_with_breaks):
+			return
+		if interested_party is None:
+			return
+
+		# Only what they've enabled is of interest (default nothing)
+		locations = cls._enabled_by_party.get(interested_party)
+		if not locations:
+			return
 
 		# Possible breakpoints are not only the function or line trigger,
 		#   but also any breakpoint that can fire anywhere.
-		location_by_line = cls.frame_location_by_line(frame)
-		location_by_function = cls.frame_location_by_function(frame)
-
-		possible = set( cls._break_locations[(None,None)]
-					  | cls._break_locations.get((None, location_by_line[1]), set())
-			          | cls._break_locations.get((None, location_by_function[1]), set())
-					  | cls._break_locations.get(location_by_line, set())
-			          | cls._break_locations.get(location_by_function, set()) )
+		filename = files_with_breaks.get(code.co_filename)
+		in_file = locations.get(filename) if filename else None
+		anywhere = locations.get(None)
 
-		# Check candidate locations
-		for breakpoint in possible:
-
-			# Check if it's enabled for them (default no)
-			if not breakpoint.enabled[interested_party]:
-				continue
+		line_number = frame.f_lineno
+		function_name = code.co_name
 
-			# Check if the breakpoints trips for this context (always true for (None,None))
-			if not breakpoint.trip(frame):
+		for located in (anywhere, in_file):
+			if not located:
 				continue
+			for key in (None, line_number, function_name):
+				for breakpoint in located.get(key, EMPTY_FROZENSET):
+
+					# Enabled by construction, but it may have been removed since
+					state = breakpoint._party_state.get(interested_party)
+					if state is None:
+						continue
+
+					# Check if the breakpoints trips for this context (always true for contextless)
+					if not breakpoint.trip(frame):
+						continue
+
+					# Count each pass over the breakpoint while it's enabled
+					#   Note that this is not filtered - it counts all executions
+					breakpoint.hits += 1
+
+					condition_code = breakpoint._condition_code
+					if condition_code is not None:
+						# Attempt to evaluate the condition
+						try:
+							# Sure, eval is evil... but we're in debug so all bets are off
+							# Note that this is like PDB: it takes a string (compiled when set) or code.
+							#   A function will need to be either in scope or compiled beforehand!
+							if not _eval(condition_code, frame.f_globals, frame.f_locals):
+								continue
+						# If the condition fails to eval, then break just to be safe
+						#   but don't modify the ignore settings, also to be safe. (PDB compliance)
+						except:
+							yield breakpoint
+							continue
 
-			# Count each pass over the breakpoint while it's enabled
-			#   Note that this is not filtered - it counts all executions
-			breakpoint.hits += 1
-
-			if not breakpoint.condition:
+					# If interested_party chose to ignore the breakpoint,
+					#   decrement the counter and pass on...
+					ignored = state.ignored
+					if ignored > 0:
+						state.ignored = ignored - 1
+						continue
 
-				# If interested_party chose to ignore the breakpoint,
-				#   decrement the counter and pass on...
-				if breakpoint.ignored[interested_party] > 0:
-					breakpoint.ignored[interested_party] -= 1
-					continue
-				# ... otherwise pass it in
-				else:
-					relevant.add(breakpoint)
+					# ... otherwise pass it in
+					#   (temporary ones are spent now, in case the caller stops here)
 					if breakpoint.temporary:
 						breakpoint._remove()
-					continue
+					yield breakpoint
 
-			else:
-				# Attempt to evaluate the condition
-				try:
-					# Sure, eval is evil... but we're in debug so all bets are off
-					# Note that this is like PDB: it expects a string or compiled code here.
-					#   A function will need to be either in scope or compiled beforehand!
-					result = eval(breakpoint.condition, 
-								  frame.f_globals,
-								  frame.f_locals)
-					if result:
-						# If interested_party chose to ignore the breakpoint,
-						#   decrement the counter and pass on...
-						if breakpoint.ignored[interested_party] > 0:
-							breakpoint.ignored[interested_party] -= 1
-							continue
-						# ... otherwise pass it in
-						else:
-							relevant.add(breakpoint)
-							if breakpoint.temporary:
-								breakpoint._remove()
-							continue							
-				# If the condition fails to eval, then break just to be safe
-				#   but don't modify the ignore settings, also to be safe. (PDB compliance)
-				except:
-					relevant.add(breakpoint)
-					continue
 
-		return relevant
+	@classmethod
+	def relevant_breakpoints(cls, frame, interested_party=None):
+		"""Get the breakpoints the interested_party should stop on for this frame.
+
+		This runs on every traced line, so when nothing is relevant the same
+		  empty frozenset is returned. Treat the result as read-only.
+
+		As with iter_relevant_breakpoints, the interested_party must be weakly
+		  referenceable, and the default of None has nothing enabled.
+		"""
+		# Most lines aren't at a breakpoint, so check that before making a generator
+		if not cls._fast_trace(frame):
+			return EMPTY_FROZENSET
+
+		return set(cls.iter_relevant_breakpoints(frame, interested_party)) or EMPTY_FROZENSET
+
+
+	@classmethod
+	def any_relevant_breakpoint(cls, frame, interested_party=None):
+		"""Check if the interested_party should stop on this frame, stopping at the first breakpoint found."""
+		if not cls._fast_trace(frame):
+			return False
+		return next(cls.iter_relevant_breakpoints(frame, interested_party), None) is not None
 
 
 	def configuration(self, interested_party=None):
+		if interested_party:
+			state = self._party_state.get(interested_party)
+			ignore_remaining = state.ignored if state else 0
+		else:
+			ignore_remaining = dict((party, state.ignored) for party, state in self._party_state.items())
 		return {
 			'hits': self.hits,
 			'temporary': self.temporary,
 			'condition': self.condition,
-			'ignore_remaining': self.ignored[interested_party] if interested_party else self.ignored,
+			'ignore_remaining': ignore_remaining,
 			'location': '%s:%s' % (self.filename or '<ANYWHERE>', self.function_name or self.line_number)
 		}
 	
 
 	def __str__(self):
+		# Breakpoints get logged a lot, and rarely change
+		if self._str_cache is None:
+			self._str_cache = self._format()
+		return self._str_cache
+
+	def _format(self):
 		meta = []
 		if self.temporary:
 			meta.append('temporary')
@@ -298,6 +568,56 @@ class Breakpoint(object):
 		return self.__str__() # for now... should add conditional 
 
 
+# Breakpoints are filed by filename and then by location, where the
+#   breakpoints at a location are a tuple that gets replaced whole.
+
+def _file_breakpoint(locations, breakpoint):
+	in_file = locations.setdefault(breakpoint.filename, {})
+	location_key = breakpoint._location_key
+	in_file[location_key] = in_file.get(location_key, ()) + (breakpoint,)
+
+def _unfile_breakpoint(locations, breakpoint):
+	"""Remove the breakpoint, pruning emptied entries. Returns if any remain in its file."""
+	in_file = locations.get(breakpoint.filename)
+	if not in_file:
+		return False
+	location_key = breakpoint._location_key
+	remaining = tuple(other for other in in_file.get(location_key, ()) 
+					  if other is not breakpoint)
+	if remaining:
+		in_file[location_key] = remaining
+	else:
+		in_file.pop(location_key, None)
+
+	if not in_file:
+		del locations[breakpoint.filename]
+		return False
+	return True
+
+
+# Resolvers for Breakpoint.resolve_breakpoints, by type of reference.
+#   Each adds the breakpoints referred to onto the given list.
+
+def _resolve_instance(cls, breakpoint, breakpoints):
+	breakpoints.append(breakpoint)
+
+def _resolve_id(cls, breakpoint_id, breakpoints):
+	breakpoints.append(cls._instances[breakpoint_id])
+
+def _resolve_filename(cls, filename, breakpoints):
+	"""Strings are all the breakpoints in a file, unless they're an ID (as typed in a command)."""
+	if filename.isdigit():
+		breakpoints.append(cls._instances[int(filename)])
+		return
+	# Breakpoints are filed under the normalized name, so either spelling works
+	for located in cls._break_locations.get(normalize_filename(filename), {}).values():
+		breakpoints.extend(located)
+
+_BREAKPOINT_RESOLVERS = {Breakpoint: _resolve_instance}
+_BREAKPOINT_RESOLVERS.update((int_type, _resolve_id) for int_type in _INT_TYPES)
+_BREAKPOINT_RESOLVERS.update((str_type, _resolve_filename) for str_type in _STR_TYPES)
+
+
 def set_breakpoint(note=''):
 	import sys
 	frame = sys._getframe(1)
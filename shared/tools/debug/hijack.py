@@ -34,6 +34,10 @@ __maintainer__ = 'Andrew Geiger'
 __email__ = 'andrew.geiger@corsosystems.com'
 
 
+# Checked on every property read, so skip the attribute lookup on Thread
+_currentThread = Thread.currentThread
+
+
 class DefSysHijack(object):
 	"""The main SysHijack class. 
 	By adding a subclass, attribute resolution works reliably in the __getattr__ and __setattr__ overrides.
@@ -41,19 +45,23 @@ class DefSysHijack(object):
 
 	__slots__ = (
 				 '_target_thread', 
+				 '_cached_thread_state',
 				 '_io_proxy',
 				 '__weakref__',
 	             )
 
 	def __init__(self, thread):
 		self._target_thread = thread
+		self._cached_thread_state = None
 		self._io_proxy = ProxyIO(hijacked_sys=self)
 		self._install()
 		
 		
 	def _install(self):
 		"""Redirect all I/O to proxy's endpoints"""
-		self._io_proxy.install()
+		# Installing twice would wrap the proxy's own streams
+		if not self._io_proxy.installed:
+			self._io_proxy.install()
 			
 	def _restore(self):
 		"""Restore all I/O to original's endpoints"""
@@ -64,12 +72,19 @@ class DefSysHijack(object):
 	def _thread_state(self):
 		"""If we're in the same thread, we need to grab the state from the master Py object.
 		Otherwise we rip it from the thread itself. 
-		We'll also want this to be calculated every call to ensure it's the correct reference. 
+
+		Ripping it out takes reflection, but a thread keeps the same state object
+		  for its whole life, so that is only done once. The system state on it
+		  can change, though, so _thread_sys still reads it every call.
 		"""
-		if Thread.currentThread() is self._target_thread:
+		if _currentThread() is self._target_thread:
 			return Py.getThreadState()
-		else:
-			return getThreadState(self._target_thread)
+
+		thread_state = self._cached_thread_state
+		if thread_state is None:
+			thread_state = getThreadState(self._target_thread)
+			self._cached_thread_state = thread_state
+		return thread_state
 	
 	@property
 	def _thread_sys(self):
@@ -139,19 +154,28 @@ class DefSysHijack(object):
 class SysHijack(DefSysHijack):
 	"""Capture a thread's system state and redirect it's standard I/O."""
 
+	# Everything else is set on the wrapped sys, so no instance dict is needed
+	__slots__ = ()
+
 	# Override masking mechanic (the hijack)
+
+	# Anything not stored on the hijack itself is passed to the wrapped sys
+	_SLOTS = frozenset(DefSysHijack.__slots__)
 	
 	def __getattr__(self, attribute):
-		"""Get from this class first, otherwise use the wrapped item."""
-		try:
-			return super(SysHijack, self).__getattr__(attribute)
-		except AttributeError:
-			return getattr(self._thread_sys, attribute)
+		"""Get from this class first, otherwise use the wrapped item.
+
+		This is only called once normal lookup fails, so go straight to the wrapped item.
+		  (Unless it's an unset slot - resolving the wrapped item would need it!)
+		"""
+		if attribute in self._SLOTS:
+			raise AttributeError(attribute)
+		return getattr(self._thread_sys, attribute)
 	
 	
 	def __setattr__(self, attribute, value):
 		"""Set to this class first, otherwise use the wrapped item."""
-		try:
-			super(SysHijack, self).__setattr__(attribute, value)
-		except AttributeError:
+		if attribute in self._SLOTS:
+			object.__setattr__(self, attribute, value)
+		else:
 			setattr(self._thread_sys, attribute, value)
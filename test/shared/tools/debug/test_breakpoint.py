@@ -0,0 +1,236 @@
+import unittest
+import sys
+import gc
+import weakref
+from types import CodeType
+
+from shared.tools.debug.breakpoint import Breakpoint
+
+
+class Party(object):
+	"""Stands in for a Tracer as an interested party."""
+
+
+def trace_hits(interested_party, function, *args):
+	"""Run the function under trace, returning the line numbers breakpoints were relevant on."""
+	hits = []
+	def tracer(frame, event, arg):
+		for breakpoint in Breakpoint.relevant_breakpoints(frame, interested_party):
+			hits.append(frame.f_lineno)
+		return tracer
+	sys.settrace(tracer)
+	try:
+		function(*args)
+	finally:
+		sys.settrace(None)
+	return hits
+
+
+def load_module(source, filename, namespace=None):
+	"""Execute the source as though it were a module with the given filename."""
+	if namespace is None:
+		namespace = {}
+	exec(compile(source, filename, 'exec'), namespace)
+	return namespace
+
+
+def frame_at(filename, line_number):
+	"""Get a frame on the given line of a module with the given filename."""
+	return load_module('\n' * (line_number - 1) + 'frame = sys._getframe()', filename, {'sys': sys})['frame']
+
+
+LOOP_SOURCE = """
+def run():
+	for i in range(6):
+		x = i
+"""
+
+
+class BreakpointTestCase(unittest.TestCase):
+
+	def setUp(self):
+		self.party = Party()
+
+	def tearDown(self):
+		for breakpoint in list(Breakpoint._instances.values()):
+			breakpoint._remove()
+
+
+	def test_functionRebound(self):
+		module = load_module('def foo():\n\treturn 1\n\ndef call():\n\treturn foo()\n', 'mod.py')
+
+		Breakpoint('mod.py', 'foo').enable(self.party)
+		self.assertEqual([1], trace_hits(self.party, module['call']))
+
+		# Redefine foo further down, like a hotload would
+		load_module('\n' * 6 + 'def foo():\n\treturn 2\n', 'mod.py', module)
+		self.assertEqual([7], trace_hits(self.party, module['call']))
+
+	def test_moduleReloaded(self):
+		source = 'def foo():\n\treturn 1\n\ndef call():\n\treturn foo()\n'
+		Breakpoint('mod.py', 'foo').enable(self.party)
+
+		self.assertEqual([1], trace_hits(self.party, load_module(source, 'mod.py')['call']))
+		self.assertEqual([6], trace_hits(self.party, load_module('\n' * 5 + source, 'mod.py')['call']))
+
+
+	def test_resolveFilenameSpellings(self):
+		breakpoint = Breakpoint('module:foo', 3)
+		self.assertEqual([breakpoint], Breakpoint.resolve_breakpoints(['module:foo']))
+		self.assertEqual([breakpoint], Breakpoint.resolve_breakpoints(['<module:foo>']))
+		self.assertEqual([breakpoint], Breakpoint.resolve_breakpoints([str(breakpoint.id)]))
+
+
+	def test_noneIsNotAParty(self):
+		breakpoint = Breakpoint('mod.py', 3)
+		self.assertRaises(TypeError, breakpoint.enable, None)
+		self.assertRaises(TypeError, breakpoint.ignore, None, 2)
+
+		# Nothing can be enabled for no one
+		breakpoint.disable(None)
+		self.assertEqual({}, breakpoint.configuration(None)['ignore_remaining'])
+		self.assertEqual(frozenset(), Breakpoint.relevant_breakpoints(sys._getframe(), None))
+
+
+	def test_fastTraceFollowsBreakpoints(self):
+		module = load_module('def foo():\n\treturn sys._getframe()\n', 'a.py', {'sys': sys})
+		at_line = frame_at('a.py', 3)
+		self.assertFalse(Breakpoint._fast_trace(at_line))
+
+		by_line = Breakpoint('a.py', 3)
+		by_function = Breakpoint('a.py', 'foo')
+		self.assertTrue(Breakpoint._fast_trace(at_line))
+		self.assertTrue(Breakpoint._fast_trace(module['foo']()))
+		self.assertFalse(Breakpoint._fast_trace(frame_at('a.py', 4)))
+		self.assertFalse(Breakpoint._fast_trace(frame_at('b.py', 3)))
+
+		by_line._remove()
+		self.assertFalse(Breakpoint._fast_trace(at_line))
+		self.assertTrue(Breakpoint._fast_trace(module['foo']()))
+
+		by_function._remove()
+		self.assertFalse(Breakpoint._fast_trace(module['foo']()))
+
+
+	def test_anyFileBreakpoint(self):
+		breakpoint = Breakpoint(None, 4)
+		breakpoint.enable(self.party)
+		self.assertIn(None, Breakpoint._files_with_breaks)
+		self.assertTrue(Breakpoint._fast_trace(frame_at('elsewhere.py', 1)))
+
+		for filename in ('a.py', 'b.py'):
+			module = load_module(LOOP_SOURCE, filename)
+			self.assertEqual([4] * 6, trace_hits(self.party, module['run']))
+
+		breakpoint._remove()
+		self.assertNotIn(None, Breakpoint._files_with_breaks)
+		self.assertFalse(Breakpoint._fast_trace(frame_at('elsewhere.py', 1)))
+
+
+	def test_fileGate(self):
+		Breakpoint('a.py', 4).enable(self.party)
+		self.assertEqual('a.py', Breakpoint._files_with_breaks['a.py'])
+
+		# Frames in files without breakpoints never get as far as the party's breakpoints
+		self.assertEqual([], list(Breakpoint.iter_relevant_breakpoints(frame_at('b.py', 4), self.party)))
+		self.assertEqual([], trace_hits(self.party, load_module(LOOP_SOURCE, 'b.py')['run']))
+		self.assertEqual([4] * 6, trace_hits(self.party, load_module(LOOP_SOURCE, 'a.py')['run']))
+
+
+	def test_conditionCompiledOnce(self):
+		module = load_module(LOOP_SOURCE, 'a.py')
+		breakpoint = Breakpoint('a.py', 4, condition='i == 3')
+		breakpoint.enable(self.party)
+		self.assertTrue(isinstance(breakpoint._condition_code, CodeType))
+		self.assertEqual([4], trace_hits(self.party, module['run']))
+
+		# A bad condition fails when it's set, not on every traced line, and leaves the last one be
+		self.assertRaises(SyntaxError, setattr, breakpoint, 'condition', 'i ==')
+		self.assertEqual('i == 3', breakpoint.condition)
+
+		# Code is taken as it is
+		breakpoint.condition = compile('i > 3', '<test>', 'eval')
+		self.assertTrue(breakpoint._condition_code is breakpoint.condition)
+		self.assertEqual([4, 4], trace_hits(self.party, module['run']))
+
+		breakpoint.condition = None
+		self.assertEqual(None, breakpoint._condition_code)
+		self.assertEqual([4] * 6, trace_hits(self.party, module['run']))
+
+
+	def test_deadPartyDropped(self):
+		breakpoint = Breakpoint('a.py', 4)
+		breakpoint.enable(self.party)
+
+		other_party = Party()
+		breakpoint.enable(other_party)
+		breakpoint.ignore(other_party, 3)
+		other_party_ref = weakref.ref(other_party)
+
+		del other_party
+		gc.collect()
+		self.assertEqual(None, other_party_ref())
+		self.assertEqual([self.party], list(breakpoint._party_state.keys()))
+
+
+	def test_ignoreCountAfterCondition(self):
+		module = load_module(LOOP_SOURCE, 'a.py')
+		breakpoint = Breakpoint('a.py', 4, condition='i % 2 == 0')
+		breakpoint.enable(self.party)
+		breakpoint.ignore(self.party, 1)
+
+		# i is 0, 2, and 4 when the condition holds, but the first is ignored
+		self.assertEqual([4, 4], trace_hits(self.party, module['run']))
+		self.assertEqual(6, breakpoint.hits)
+		self.assertEqual(0, breakpoint.configuration(self.party)['ignore_remaining'])
+
+
+	def test_temporaryRemovedOnceTripped(self):
+		module = load_module(LOOP_SOURCE, 'a.py')
+		kept = Breakpoint('a.py', 4)
+		breakpoint = Breakpoint('a.py', 4, temporary=True)
+		self.assertEqual((kept, breakpoint), Breakpoint._break_locations['a.py'][4])
+
+		breakpoint.enable(self.party)
+		self.assertEqual([4], trace_hits(self.party, module['run']))
+		self.assertNotIn(breakpoint.id, Breakpoint._instances)
+		self.assertEqual((kept,), Breakpoint._break_locations['a.py'][4])
+
+		# The file is only dropped once its last breakpoint is
+		kept._remove()
+		self.assertNotIn('a.py', Breakpoint._break_locations)
+		self.assertNotIn('a.py', Breakpoint._files_with_breaks)
+		self.assertNotIn('<a.py>', Breakpoint._files_with_breaks)
+
+
+	def test_codeFilenameSpellings(self):
+		breakpoint = Breakpoint('<module:demo>', 4)
+		breakpoint.enable(self.party)
+		self.assertEqual('module:demo', breakpoint.filename)
+
+		for spelling in ('module:demo', '<module:demo>'):
+			self.assertTrue(Breakpoint._files_with_breaks[spelling] is breakpoint.filename)
+			module = load_module(LOOP_SOURCE, spelling)
+			self.assertEqual([4] * 6, trace_hits(self.party, module['run']))
+
+
+	def test_enabledIndex(self):
+		module = load_module(LOOP_SOURCE, 'a.py')
+		breakpoint = Breakpoint('a.py', 4)
+		Breakpoint('a.py', 3)
+
+		# Only what the party enabled is indexed for it
+		breakpoint.enable(self.party)
+		self.assertEqual({'a.py': {4: (breakpoint,)}}, Breakpoint._enabled_by_party[self.party])
+		breakpoint.disable(self.party)
+		self.assertEqual({}, Breakpoint._enabled_by_party[self.party])
+		self.assertEqual([], trace_hits(self.party, module['run']))
+
+		temporary = Breakpoint('a.py', 4, temporary=True)
+		temporary.enable(self.party)
+		self.assertEqual([4], trace_hits(self.party, module['run']))
+		self.assertEqual({}, Breakpoint._enabled_by_party[self.party])
+
+
+suite = unittest.TestLoader().loadTestsFromTestCase(BreakpointTestCase)
+unittest.TextTestRunner(verbosity=1).run(suite)